@@ -1,23 +1,123 @@
 import datetime
+import hashlib
 import os
+import pickle
 import re
+import shutil
+import subprocess
 import sys
-from argparse import ArgumentParser
-from copy import deepcopy
-from os import popen
+from argparse import ArgumentParser, HelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from os.path import expandvars
 from pathlib import Path
+from shlex import quote as shlex_quote
+from string import Formatter
 from textwrap import dedent, indent
 
-from git import Repo
-from git.exc import GitCommandError
-from yaml import safe_load
-
 ROOT = Path(__file__).resolve().parent
+# the launcher never changes directory: paths are displayed relative to this one
+CWD = Path.cwd()
 
 GIT_WARNING = True
 
-
+# sbatch executable, resolved once
+SBATCH = shutil.which("sbatch") or "sbatch"
+# Maximum number of concurrent sbatch calls
+SBATCH_WORKERS = 16
+
+# Special variables known to resolve_env_vars
+ENV_SUBS = {"$root": str(ROOT), "$repoName": ROOT.name}
+ENV_RE = re.compile("|".join(re.escape(k) for k in ENV_SUBS))
+
+# Path prefixes to shorten when printing paths, by order of priority
+PATH_SUBS = {
+    k: v
+    for k, v in [
+        (str(ROOT), "$root"),
+        (os.environ.get("HOME", ""), "~"),
+        (os.environ.get("SCRATCH", ""), "$SCRATCH"),
+    ]
+    if k
+}
+PATH_RE = re.compile("|".join(re.escape(k) for k in PATH_SUBS))
+
+# Parsed yaml files, as {absolute_path: (st_mtime_ns, st_size, content)}
+YAML_CACHE = {}
+# Parsed yaml files, pickled across runs
+YAML_CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME") or "~/.cache").expanduser()
+    / "mila-launch"
+    / "yaml"
+)
+
+# job id in sbatch's output
+SBATCH_ID_RE = re.compile(r"Submitted batch job (\d+)")
+# `#SBATCH --param=` lines with an empty value
+EMPTY_SBATCH_RE = re.compile(r"^#SBATCH[^\n=]*=[^\S\n]*$\n?", re.MULTILINE)
+# parentheses escaping for script args
+QUOTE_TRANS = str.maketrans({"(": r"\(", ")": r"\)"})
+# separators around sbatch scripts printed in dry-run & verbose modes
+SBATCH_HEADER = "#" * 40 + " <sbatch> " + "#" * 40
+SBATCH_FOOTER = "#" * 40 + " </sbatch> " + "#" * 39
+
+# (name, type, help) of the command-line arguments. `bool` arguments are flags.
+# Defaults are appended to the help by `LaunchHelpFormatter`, only when printed.
+ARGS_SPEC = [
+    ("job_name", str, "slurm job name to show in squeue."),
+    ("outdir", str, "where to write the slurm .out file."),
+    ("cpus_per_task", int, "number of cpus per SLURM task."),
+    ("mem", str, "memory per node (e.g. 32G)."),
+    ("gres", str, "gres per node (e.g. gpu:1)."),
+    ("partition", str, "slurm partition to use for the job."),
+    (
+        "time",
+        str,
+        "wall clock time limit (e.g. 2-12:00:00). "
+        + "See: https://slurm.schedmd.com/sbatch.html#OPT_time",
+    ),
+    ("modules", str, "string after 'module load'."),
+    ("conda_env", str, "conda environment name."),
+    ("venv", str, "path to venv (without bin/activate)."),
+    ("template", str, "path to sbatch template."),
+    ("code_dir", str, "cd before running main.py."),
+    (
+        "git_checkout",
+        str,
+        "Branch or commit to checkout before running the code."
+        + " This is only used if --code_dir='$SLURM_TMPDIR'. If not specified, "
+        + " the current branch is used.",
+    ),
+    (
+        "jobs",
+        str,
+        "jobs (nested) file name in external/jobs (with or without .yaml)."
+        + " Or an absolute path to a yaml file anywhere",
+    ),
+    ("dry_run", bool, "Don't run just, show what it would have run."),
+    ("verbose", bool, "print templated sbatch after running it."),
+    ("force", bool, "Skip user confirmation."),
+    ("command", str, "Command to run."),
+    ("script_path", str, "Script to run by command."),
+    ("sbatch_files_root", str, "Where to write the sbatch files."),
+    ("allow_unclean_repo", bool, "Raise an error if the git repo is not clean."),
+    ("allow_no_checkout", bool, "Warn if no git checkout is provided."),
+    (
+        "array_batch",
+        int,
+        "Submit jobs with the same SLURM params as job arrays of at most"
+        + " this many jobs. Disabled if lower than 2.",
+    ),
+    (
+        "dedupe_jobs",
+        bool,
+        "Only submit the first of jobs rendering the exact same sbatch script.",
+    ),
+    ("clone_as_https", bool, "Clone the repo as https instead of ssh."),
+]
+
+
+@lru_cache(maxsize=512)
 def resolve_env_vars(string):
     """
     Resolves environment variables in a string.
@@ -32,7 +132,9 @@ def resolve_env_vars(string):
     Returns:
         str: resolved string
     """
-    candidate = string.replace("$root", str(ROOT)).replace("$repoName", ROOT.name)
+    if "$" not in string:
+        return string
+    candidate = ENV_RE.sub(lambda m: ENV_SUBS[m.group(0)], string)
     if "$" in candidate:
         candidate = expandvars(candidate)
     return candidate
@@ -51,7 +153,23 @@ def resolve(path):
     """
     if path is None:
         return None
-    path = str(path).replace("$root", str(ROOT))
+    # str and Path versions of the same path share the same cache entry
+    return resolve_str(str(path))
+
+
+@lru_cache(maxsize=512)
+def resolve_str(path):
+    """
+    Cached implementation of `resolve` for string paths: launch.py is
+    short-lived, the environment and the current working directory don't
+    change during a run.
+
+    Args:
+        path (str): The path to resolve
+
+    Returns:
+        Path: resolved path
+    """
     return Path(resolve_env_vars(path)).expanduser().resolve()
 
 
@@ -66,6 +184,81 @@ def now_str():
     return datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
 
+def cached_safe_load(path):
+    """
+    Loads a yaml file, re-using the previously parsed content if the file has
+    not changed since (same modification time and size).
+
+    Parsed files are cached in memory for the current run and on disk
+    (see `load_yaml`) across runs.
+
+    The returned object is shared across calls: callers must *not* mutate it.
+
+    Args:
+        path (str | Path): The yaml file to load
+
+    Returns:
+        Any: parsed yaml content
+    """
+    path = str(Path(path).resolve())
+    stat = os.stat(path)
+    cached = YAML_CACHE.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    content = load_yaml(path, stat)
+    YAML_CACHE[path] = (stat.st_mtime_ns, stat.st_size, content)
+    return content
+
+
+def load_yaml(path, stat):
+    """
+    Parses a yaml file, going through an on-disk pickle cache in
+    `YAML_CACHE_DIR` keyed by the file's path, modification time and size.
+
+    Caching is best-effort: any issue reading or writing the cache falls back
+    to parsing the yaml file.
+
+    Args:
+        path (str): absolute path to the yaml file
+        stat (os.stat_result): the file's current stat
+
+    Returns:
+        Any: parsed yaml content
+    """
+    key = hashlib.sha1(path.encode()).hexdigest()
+    cache_path = YAML_CACHE_DIR / f"{key}_{stat.st_mtime_ns}_{stat.st_size}.pkl"
+    try:
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    except Exception:  # missing or corrupted cache file
+        pass
+
+    # only imported on cache misses: PyYAML's import dominates a warm run
+    from yaml import load
+
+    try:
+        from yaml import CSafeLoader as SafeLoader  # libyaml-backed parser
+    except ImportError:
+        from yaml import SafeLoader
+
+    with open(path, "r") as f:
+        content = load(f, Loader=SafeLoader)
+
+    try:
+        YAML_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # remove caches of previous versions of the file
+        for stale in YAML_CACHE_DIR.glob(f"{key}_*.pkl"):
+            stale.unlink(missing_ok=True)
+        # write then rename so that concurrent runs never read a partial file
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(content, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return content
+
+
 def load_jobs(yaml_path):
     """
     Loads a yaml file with run configurations and turns it into a list of jobs.
@@ -106,18 +299,17 @@ def load_jobs(yaml_path):
     """
     if yaml_path is None:
         return []
-    with open(yaml_path, "r") as f:
-        jobs_config = safe_load(f)
+    jobs_config = cached_safe_load(yaml_path)
 
     shared_slurm = jobs_config.get("shared", {}).get("slurm", {})
     shared_script = jobs_config.get("shared", {}).get("script", {})
     jobs = []
     for job_dict in jobs_config["jobs"]:
+        # the cached yaml content is never mutated: deep_update copies `a`
+        # and `job_dict` is replaced by a new dict
         job_slurm = deep_update(shared_slurm, job_dict.get("slurm", {}))
         job_script = deep_update(shared_script, job_dict.get("script", {}))
-        job_dict["slurm"] = job_slurm
-        job_dict["script"] = job_script
-        jobs.append(job_dict)
+        jobs.append({**job_dict, "slurm": job_slurm, "script": job_script})
     return jobs
 
 
@@ -144,9 +336,18 @@ def find_jobs_conf(conf):
             conf["jobs"] = conf["jobs"][9:]
         if conf["jobs"].startswith("jobs/"):
             conf["jobs"] = conf["jobs"][5:]
+        # probe the two possible files directly rather than globbing
+        jobs_base = ROOT / "config" / "jobs" / conf["jobs"]
         yamls = [
-            str(y) for y in (ROOT / "config" / "jobs").glob(f"{conf['jobs']}.y*ml")
+            f"{jobs_base}{ext}"
+            for ext in (".yaml", ".yml")
+            if os.path.isfile(f"{jobs_base}{ext}")
         ]
+        if not yamls:
+            # only glob when needed, for names with wildcards (e.g. `ViT/v*`)
+            yamls = [
+                str(y) for y in (ROOT / "config" / "jobs").glob(f"{conf['jobs']}.y*ml")
+            ]
         if len(yamls) == 0:
             raise ValueError(
                 f"Could not find {conf['jobs']}.y(a)ml in ./external/jobs/"
@@ -163,58 +364,79 @@ def find_jobs_conf(conf):
 
 
 def quote(value):
-    v = str(value)
-    v = v.replace("(", r"\(").replace(")", r"\)")
+    """
+    Escapes parentheses and quotes values containing spaces or `=` so that
+    they can be used as a command-line arg.
+
+    Values are double-quoted when possible so that environment variables
+    (e.g. `$USER`) are still expanded in the sbatch script, and parentheses
+    are escaped for Hydra: `shlex.quote` is only used as a last resort.
+
+    Args:
+        value (Any): value to quote
+
+    Returns:
+        str: quoted value
+    """
+    if isinstance(value, (bool, int, float)):
+        return str(value)  # nothing to escape nor quote
+    v = str(value).translate(QUOTE_TRANS)
     if " " in v or "=" in v:
         if '"' not in v:
             v = f'"{v}"'
         elif "'" not in v:
             v = f"'{v}'"
         else:
-            raise ValueError(f"Cannot quote {value}")
+            # both kinds of quotes: let shlex escape the single quotes
+            v = shlex_quote(v)
     return v
 
 
-def script_dict_to_script_args_str(script_dict, is_first=True, nested_key=""):
+def script_dict_to_script_args_str(script_dict, nested_key=""):
     """
-    Recursively turns a dict of script args into a string of main.py args
-    as `nested.key=value` pairs
+    Turns a (nested) dict of script args into a string of main.py args
+    as `nested.key=value` pairs.
+
+    The dict is walked depth-first with an explicit stack and args are
+    accumulated in a list joined once at the end.
 
     Args:
         script_dict (dict): script dictionary of args
-        previous_str (str, optional): base string to append to. Defaults to "".
-    """
-    if not isinstance(script_dict, dict):
-        candidate = f"{nested_key}={quote(script_dict)}"
-        if candidate.count("=") > 1:
-            assert "'" not in candidate, """Keys cannot contain ` ` and `'` and `=` """
-            candidate = f"'{candidate}'"
-        return candidate + " "
-    new_str = ""
-    for k, v in script_dict.items():
-        if k == "__value__":
-            value = str(v)
-            if " " in value:
-                value = f"'{value}'"
-            candidate = f"{nested_key}={quote(v)} "
+        nested_key (str, optional): key to prefix args with. Defaults to "".
+
+    Returns:
+        str: space-separated script args
+    """
+    args = []
+    stack = [(nested_key, script_dict)]
+    while stack:
+        key, value = stack.pop()
+        if not isinstance(value, dict):
+            candidate = f"{key}={quote(value)}"
             if candidate.count("=") > 1:
-                assert (
-                    "'" not in candidate
-                ), """Keys cannot contain ` ` and `'` and `=` """
-                candidate = f"'{candidate}'"
-            new_str += candidate
+                # single-quoted as a whole, escaping single quotes if any
+                candidate = shlex_quote(candidate)
+            args.append(candidate)
             continue
-        new_key = k if not nested_key else nested_key + "." + str(k)
-        new_str += script_dict_to_script_args_str(v, nested_key=new_key, is_first=False)
-    if is_first:
-        new_str = new_str.strip()
-    return new_str
+        # push in reverse order so that args are popped in the dict's order
+        for k, v in reversed(value.items()):
+            if k == "__value__":
+                stack.append((key, v))
+            else:
+                stack.append((k if not key else f"{key}.{k}", v))
+    return " ".join(args)
 
 
-def deep_update(a, b, path=None, verbose=None):
+def deep_update(a, b, verbose=None):
     """
     https://stackoverflow.com/questions/7204805/how-to-merge-dictionaries-of-dictionaries/7205107#7205107
 
+    Nested dicts are merged iteratively with an explicit stack rather than
+    through recursive calls.
+
+    Copies are copy-on-write: only `a` and the nested dicts which are updated
+    are (shallow) copied, other values are shared between `a` and the result.
+
     Args:
         a (dict): dict to update
         b (dict): dict to update from
@@ -222,24 +444,73 @@ def deep_update(a, b, path=None, verbose=None):
     Returns:
         dict: updated copy of a
     """
-    if path is None:
-        path = []
-        a = deepcopy(a)
-    for key in b:
-        if key in a:
-            if isinstance(a[key], dict) and isinstance(b[key], dict):
-                deep_update(a[key], b[key], path + [str(key)])
-            elif a[key] == b[key]:
-                pass  # same leaf value
+    a = dict(a)
+    if not b:
+        return a
+    # key paths are only tracked to print warnings
+    stack = [(a, b, [] if verbose else None)]
+    while stack:
+        da, db, dpath = stack.pop()
+        if da.keys().isdisjoint(db):
+            # nothing to merge: new keys are added as-is, without walking them
+            da.update(db)
+            continue
+        for key, value in db.items():
+            if key in da:
+                if type(da[key]) is dict and type(value) is dict:
+                    da[key] = dict(da[key])
+                    key_path = dpath + [str(key)] if verbose else None
+                    stack.append((da[key], value, key_path))
+                elif da[key] == value:
+                    pass  # same leaf value
+                else:
+                    if verbose:
+                        print(">>> Warning: Overwriting", ".".join(dpath + [str(key)]))
+                    da[key] = value
             else:
-                if verbose:
-                    print(">>> Warning: Overwriting", ".".join(path + [str(key)]))
-                a[key] = b[key]
-        else:
-            a[key] = b[key]
+                da[key] = value
     return a
 
 
+def merge_priority(sources):
+    """
+    Merges dicts by decreasing order of priority: a key's value comes from the
+    first source defining it and nested dicts are merged the same way.
+
+    This is equivalent to successive `deep_update` calls from the last source
+    to the first one, but each source is walked once and none is copied or
+    mutated.
+
+    Args:
+        sources (list[dict]): dicts to merge, from highest to lowest priority
+
+    Returns:
+        dict: merged dict
+    """
+    merged = {}
+    stack = [(merged, sources)]
+    while stack:
+        dest, srcs = stack.pop()
+        nested = {}  # {key: [lower priority dicts to merge into dest[key]]}
+        closed = set()  # keys shadowing lower priority values with a dict
+        for src in srcs:
+            for key, value in src.items():
+                if key not in dest:
+                    if isinstance(value, dict):
+                        dest[key] = {}
+                        nested[key] = [value]
+                    else:
+                        dest[key] = value
+                elif key in nested and key not in closed:
+                    if isinstance(value, dict):
+                        nested[key].append(value)
+                    else:
+                        closed.add(key)
+        for key, sub_sources in nested.items():
+            stack.append((dest[key], sub_sources))
+    return merged
+
+
 def print_md_help(parser, defaults):
     help = (ROOT / "config" / "templates" / "help.md").read_text()
     example_file = ROOT / "config/jobs/example-jobs.yaml"
@@ -293,27 +564,85 @@ def get_remotes_diff(repo, git_checkout):
     Returns:
         dict, dict: behinds, aheads (as {"remote_name": int})
     """
+    from git.exc import GitCommandError
+
     behinds = {}
     aheads = {}
     for r in repo.remotes:
         try:
-            behinds[r.name] = len(
-                list(repo.iter_commits(f"{git_checkout}..{r.name}/{git_checkout}"))
+            # "{ahead}\t{behind}", in a single git call
+            counts = repo.git.rev_list(
+                "--left-right",
+                "--count",
+                f"{git_checkout}...{r.name}/{git_checkout}",
+                "--",
             )
         except GitCommandError as e:
             if "fatal: bad revision" in str(e):
                 behinds[r.name] = f"checkout {git_checkout} found on remote {r.name}"
-        try:
-            aheads[r.name] = len(
-                list(repo.iter_commits(f"{r.name}/{git_checkout}..{git_checkout}"))
-            )
-        except GitCommandError:
-            # already caught and printed in commits behind
-            pass
+            continue
+        ahead, behind = counts.split()
+        aheads[r.name] = int(ahead)
+        behinds[r.name] = int(behind)
 
     return behinds, aheads
 
 
+@lru_cache(maxsize=1)
+def get_repo():
+    """
+    Returns the git repo of the current repository. It is only instantiated
+    once per launch.py run.
+
+    Returns:
+        git.Repo: git repo at ROOT
+    """
+    from git import Repo
+
+    return Repo(ROOT)
+
+
+@lru_cache(maxsize=1)
+def get_active_branch():
+    """
+    Returns the name of the current repository's active branch.
+
+    Returns:
+        str: active branch name
+    """
+    return get_repo().active_branch.name
+
+
+@lru_cache(maxsize=1)
+def get_origin_url():
+    """
+    Returns the url of the current repository's `origin` remote.
+
+    Returns:
+        str: origin url
+    """
+    return get_repo().remotes.origin.url
+
+
+def job_code_dir(job_dict, args, conf):
+    """
+    Returns a job's (unformatted) code_dir, without building the job's whole
+    configuration.
+
+    Args:
+        job_dict (dict): job configuration from the jobs file
+        args (dict): command-line arguments
+        conf (dict): Launch configuration
+
+    Returns:
+        str: the job's code_dir
+    """
+    for source in (args, job_dict, job_dict.get("slurm", {}), conf):
+        if "code_dir" in source:
+            return str(source["code_dir"])
+    return ""
+
+
 def validate_git_status(conf):
     """
     Validates the git status of the current repo.
@@ -329,9 +658,9 @@ def validate_git_status(conf):
 
     git_checkout = conf["git_checkout"]
 
-    repo = Repo(ROOT)
+    repo = get_repo()
     if not git_checkout:
-        git_checkout = repo.active_branch.name
+        git_checkout = get_active_branch()
         if GIT_WARNING:
             if not get_user_input:
                 print("💥 Git warnings:")
@@ -398,17 +727,16 @@ def code_dir_for_slurm_tmp_dir_checkout(conf):
     Returns:
         str: multi-line formatted string
     """
+    if "SLURM_TMPDIR" not in conf["code_dir"]:
+        return str(resolve(conf["code_dir"]))
 
-    repo = Repo(ROOT)
-    git_checkout = conf["git_checkout"] or repo.active_branch.name
+    git_checkout = conf["git_checkout"] or get_active_branch()
 
-    if "SLURM_TMPDIR" not in job_conf["code_dir"]:
-        return str(resolve(job_conf["code_dir"]))
-
-    repo_url = repo.remotes.origin.url
+    origin_url = get_origin_url()
+    repo_url = origin_url
     if conf["clone_as_https"]:
-        repo_url = ssh_to_https(repo.remotes.origin.url)
-    repo_name = repo.remotes.origin.url.split(".git")[0].split("/")[-1]
+        repo_url = ssh_to_https(origin_url)
+    repo_name = origin_url.split(".git")[0].split("/")[-1]
 
     return dedent(
         """\
@@ -436,19 +764,31 @@ def load_launch_conf():
         raise ValueError(
             f"Could not find launch configuration file at {launch_conf_path}"
         )
-    with open(launch_conf_path, "r") as f:
-        launch_conf = safe_load(f)
+    launch_conf = cached_safe_load(launch_conf_path)
 
     GIT_WARNING = not launch_conf.get("allow_no_checkout", True)
 
     return launch_conf
 
 
+class LaunchHelpFormatter(HelpFormatter):
+    """
+    Appends the launch configuration's default value to each argument's help.
+    Defaults are read when the help is formatted, not when the parser is built.
+    """
+
+    def _get_help_string(self, action):
+        if action.dest not in launch_defaults:
+            return action.help
+        default = str(launch_defaults[action.dest]).replace("%", "%%")
+        return f"{action.help} Defaults to {default}"
+
+
 def parse_args_to_dict():
     """
     Parses the command-line arguments and returns a dict of args.
     """
-    parser = ArgumentParser(add_help=False)
+    parser = ArgumentParser(add_help=False, formatter_class=LaunchHelpFormatter)
     parser.add_argument(
         "-h",
         "--help",
@@ -463,150 +803,13 @@ def parse_args_to_dict():
         + "LAUNCH.md with `$ python mila/launch.py --help-md > LAUNCH.md`",
         default=None,
     )
-    parser.add_argument(
-        "--job_name",
-        type=str,
-        help="slurm job name to show in squeue."
-        + f" Defaults to {launch_defaults['job_name']}",
-    )
-    parser.add_argument(
-        "--outdir",
-        type=str,
-        help="where to write the slurm .out file."
-        + f" Defaults to {launch_defaults['outdir']}",
-    )
-    parser.add_argument(
-        "--cpus_per_task",
-        type=int,
-        help="number of cpus per SLURM task."
-        + f" Defaults to {launch_defaults['cpus_per_task']}",
-    )
-    parser.add_argument(
-        "--mem",
-        type=str,
-        help="memory per node (e.g. 32G)." + f" Defaults to {launch_defaults['mem']}",
-    )
-    parser.add_argument(
-        "--gres",
-        type=str,
-        help="gres per node (e.g. gpu:1)." + f" Defaults to {launch_defaults['gres']}",
-    )
-    parser.add_argument(
-        "--partition",
-        type=str,
-        help="slurm partition to use for the job."
-        + f" Defaults to {launch_defaults['partition']}",
-    )
-    parser.add_argument(
-        "--time",
-        type=str,
-        help="wall clock time limit (e.g. 2-12:00:00). "
-        + "See: https://slurm.schedmd.com/sbatch.html#OPT_time"
-        + f" Defaults to {launch_defaults['time']}",
-    )
-    parser.add_argument(
-        "--modules",
-        type=str,
-        help="string after 'module load'."
-        + f" Defaults to {launch_defaults['modules']}",
-    )
-    parser.add_argument(
-        "--conda_env",
-        type=str,
-        help="conda environment name." + f" Defaults to {launch_defaults['conda_env']}",
-    )
-    parser.add_argument(
-        "--venv",
-        type=str,
-        help="path to venv (without bin/activate)."
-        + f" Defaults to {launch_defaults['venv']}",
-    )
-    parser.add_argument(
-        "--template",
-        type=str,
-        help="path to sbatch template." + f" Defaults to {launch_defaults['template']}",
-    )
-    parser.add_argument(
-        "--code_dir",
-        type=str,
-        help="cd before running main.py."
-        + f" Defaults to {launch_defaults['code_dir']}",
-    )
-    parser.add_argument(
-        "--git_checkout",
-        type=str,
-        help="Branch or commit to checkout before running the code."
-        + " This is only used if --code_dir='$SLURM_TMPDIR'. If not specified, "
-        + " the current branch is used."
-        + f" Defaults to {launch_defaults['git_checkout']}",
-    )
-    parser.add_argument(
-        "--jobs",
-        type=str,
-        help="jobs (nested) file name in external/jobs (with or without .yaml)."
-        + " Or an absolute path to a yaml file anywhere"
-        + f" Defaults to {launch_defaults['jobs']}",
-    )
-    parser.add_argument(
-        "--dry_run",
-        action="store_true",
-        help="Don't run just, show what it would have run."
-        + f" Defaults to {launch_defaults['dry_run']}",
-        default=None,
-    )
-    parser.add_argument(
-        "--verbose",
-        action="store_true",
-        help="print templated sbatch after running it."
-        + f" Defaults to {launch_defaults['verbose']}",
-        default=None,
-    )
-    parser.add_argument(
-        "--force",
-        action="store_true",
-        help="Skip user confirmation." + f" Defaults to {launch_defaults['force']}",
-        default=None,
-    )
-    parser.add_argument(
-        "--command",
-        type=str,
-        help="Command to run." + f" Defaults to {launch_defaults['command']}",
-    )
-
-    parser.add_argument(
-        "--script_path",
-        type=str,
-        help="Script to run by command."
-        + f" Defaults to {launch_defaults['script_path']}",
-    )
-
-    parser.add_argument(
-        "--sbatch_files_root",
-        type=str,
-        help="Where to write the sbatch files."
-        + f" Defaults to {launch_defaults['sbatch_files_root']}",
-    )
-    parser.add_argument(
-        "--allow_unclean_repo",
-        action="store_true",
-        default=None,
-        help="Raise an error if the git repo is not clean."
-        + f" Defaults to {launch_defaults['allow_unclean_repo']}",
-    )
-    parser.add_argument(
-        "--allow_no_checkout",
-        action="store_true",
-        default=None,
-        help="Warn if no git checkout is provided."
-        + f" Defaults to {launch_defaults['allow_no_checkout']}",
-    )
-    parser.add_argument(
-        "--clone_as_https",
-        action="store_true",
-        default=None,
-        help="Clone the repo as https instead of ssh."
-        + f" Defaults to {launch_defaults['clone_as_https']}",
-    )
+    for name, arg_type, arg_help in ARGS_SPEC:
+        if arg_type is bool:
+            parser.add_argument(
+                f"--{name}", action="store_true", help=arg_help, default=None
+            )
+        else:
+            parser.add_argument(f"--{name}", type=arg_type, help=arg_help)
 
     known, unknown = parser.parse_known_args()
 
@@ -642,7 +845,7 @@ def find_template(conf):
 def dict_to_print(d):
     """
     Returns a dict with all the values as strings, and all the keys padded to
-    the same length.
+    the same length (at most 40 characters).
 
     Args:
         d (dict): dict to print
@@ -650,9 +853,8 @@ def dict_to_print(d):
     Returns:
         dict: formatted dict
     """
-    ml = max(len(k) for k in d) + 1
-    keys = sorted(d.keys())
-    return {f"{k:{ml}}": str(d[k]) if d[k] != "" else '""' for k in keys}
+    ml = min(max((len(k) for k in d), default=0) + 1, 40)
+    return {k.ljust(ml): str(d[k]) if d[k] != "" else '""' for k in sorted(d)}
 
 
 def load_template(conf):
@@ -663,10 +865,70 @@ def load_template(conf):
         conf (dict): Launch configuration
 
     Returns:
-        dict: template as a string
+        str: template as a string
     """
     template_path = find_template(conf)
-    return template_path.read_text()
+    return read_template(str(template_path), template_path.stat().st_mtime_ns)
+
+
+@lru_cache(maxsize=8)
+def read_template(path, mtime_ns):
+    """
+    Reads a template file. Results are cached by path and modification time
+    so a template is only read again if it changed.
+
+    Args:
+        path (str): path to the template file
+        mtime_ns (int): modification time of the template file
+
+    Returns:
+        str: template as a string
+    """
+    return Path(path).read_bytes().decode("utf-8")
+
+
+def split_template(template):
+    """
+    Splits a template on its `{key}` placeholders, with the same tokenization
+    as `str.format` (e.g. `{{` is a literal `{`).
+
+    Args:
+        template (str): template to split
+
+    Returns:
+        list[str]: alternating literal strings (even indices) and
+            placeholder keys (odd indices)
+    """
+    parts = [""]
+    for literal, key, _, _ in Formatter().parse(template):
+        # escaped braces split literals without a placeholder in between
+        parts[-1] += literal
+        if key is not None:
+            parts += [key, ""]
+    return parts
+
+
+def render_template(template_parts, values):
+    """
+    Renders a template split with `split_template` by replacing placeholder
+    keys with their values.
+
+    Args:
+        template_parts (list[str]): split template
+        values (dict): placeholder keys to their values (extra keys are ignored)
+
+    Raises:
+        ValueError: if a placeholder key is missing from values
+
+    Returns:
+        str: rendered template
+    """
+    rendered = template_parts[:]
+    try:
+        rendered[1::2] = [str(values[k]) for k in template_parts[1::2]]
+    except KeyError as e:
+        raise ValueError(f"No value for template key {e}") from e
+    return "".join(rendered)
 
 
 def clean_sbatch_params(templated):
@@ -679,17 +941,95 @@ def clean_sbatch_params(templated):
     Returns:
         str: cleaned sbatch file
     """
-    new_lines = []
-    for line in templated.splitlines():
-        if not line.startswith("#SBATCH"):
-            new_lines.append(line)
-            continue
-        if "=" not in line:
-            new_lines.append(line)
-            continue
-        if line.split("=")[1].strip():
-            new_lines.append(line)
-    return "\n".join(new_lines)
+    return EMPTY_SBATCH_RE.sub("", templated)
+
+
+def split_sbatch(templated):
+    """
+    Splits an sbatch script into its header and its body (the commands to run).
+
+    As for sbatch, the header is made of the leading blank and `#` lines: any
+    `#SBATCH` directive after the first command is ignored by SLURM.
+
+    Args:
+        templated (str): sbatch script
+
+    Returns:
+        str, str: the header and the body of the script
+    """
+    lines = templated.splitlines(keepends=True)
+    n = 0
+    while n < len(lines) and (lines[n].startswith("#") or not lines[n].strip()):
+        n += 1
+    return "".join(lines[:n]), "".join(lines[n:])
+
+
+def batch_submissions(submissions, array_batch):
+    """
+    Groups consecutive jobs whose sbatch scripts share the same header (i.e. the
+    same SLURM parameters) into job arrays of at most `array_batch` jobs, so
+    that they are submitted with a single sbatch call.
+
+    Array tasks run their job's commands according to `$SLURM_ARRAY_TASK_ID`
+    and write to `{job_name}-{array_id}_{task_id}.out`.
+
+    Args:
+        submissions (list): (job_conf, templated, sbatch_path) for each job
+        array_batch (int): maximum number of jobs per array. Jobs are not
+            batched if lower than 2.
+
+    Returns:
+        list: (job_confs, templated, sbatch_path) for each sbatch to submit
+    """
+    batches = []
+    headers = []
+    for job_conf, templated, sbatch_path in submissions:
+        header, body = split_sbatch(templated)
+        if (
+            array_batch > 1
+            and batches
+            and headers[-1] == header
+            and len(batches[-1][0]) < array_batch
+        ):
+            batches[-1][0].append(job_conf)
+            batches[-1][1].append(body)
+        else:
+            batches.append(([job_conf], [body], sbatch_path, templated))
+            headers.append(header)
+
+    sbatches = []
+    for header, (job_confs, bodies, sbatch_path, templated) in zip(headers, batches):
+        if len(job_confs) > 1:
+            header = header.replace("%j", "%A_%a").rstrip()
+            header += f"\n#SBATCH --array=0-{len(job_confs) - 1}\n"
+            cases = "".join(
+                f"{t})\n{body.strip()}\n;;\n" for t, body in enumerate(bodies)
+            )
+            templated = f"{header}\ncase $SLURM_ARRAY_TASK_ID in\n{cases}esac\n"
+        sbatches.append((job_confs, templated, sbatch_path))
+    return sbatches
+
+
+def submit_sbatch(templated):
+    """
+    Submits an sbatch script to SLURM through sbatch's standard input.
+
+    Args:
+        templated (str): sbatch script to submit
+
+    Raises:
+        RuntimeError: if sbatch did not print the submitted job's id
+
+    Returns:
+        str, str: sbatch's output and the submitted job id
+    """
+    proc = subprocess.run([SBATCH], input=templated, capture_output=True, text=True)
+    out = proc.stdout.strip()
+    # Identify printed-out job id
+    found = SBATCH_ID_RE.findall(out)
+    if not found:
+        raise RuntimeError(f"Could not submit job:\n{proc.stderr.strip() or out}")
+    return out, found[0]
 
 
 def relative_to_cwd(p, as_str=False):
@@ -706,18 +1046,14 @@ def relative_to_cwd(p, as_str=False):
     """
     rel = resolve(p)
     try:
-        rel = rel.relative_to(Path.cwd())
+        rel = rel.relative_to(CWD)
         if as_str:
             rel = f"./{str(rel)}"
     except ValueError:
         if as_str:
             rel = str(rel)
     if as_str:
-        rel = (
-            rel.replace(str(ROOT), "$root")
-            .replace(str(os.environ["HOME"]), "~")
-            .replace(os.environ["SCRATCH"], "$SCRATCH")
-        )
+        rel = PATH_RE.sub(lambda m: PATH_SUBS[m.group(0)], rel)
 
     return rel
 
@@ -742,8 +1078,8 @@ if __name__ == "__main__":
 
     # load sbatch template file to format
     template = load_template(conf)
-    # find the required formatting keys
-    template_known_keys = set(re.findall(r"{(\w+)}", template))
+    # split the template once, it is then rendered for each job
+    template_parts = split_template(template)
 
     # in dry run mode: no mkdir, no sbatch etc.
     dry_run = conf["dry_run"]
@@ -768,12 +1104,18 @@ if __name__ == "__main__":
     # Save submitted jobs ids
     job_ids = []
     job_out_files = []
+    failures = []
 
     # A unique datetime identifier for the jobs about to be submitted
     now = now_str()
 
     if not force and not dry_run:
-        validate_git_status(conf)
+        # the git status only matters for jobs cloning the repo in $SLURM_TMPDIR
+        if any(
+            "SLURM_TMPDIR" in job_code_dir(job_dict, args, conf)
+            for job_dict in job_dicts
+        ):
+            validate_git_status(conf)
 
         if conf["verbose"]:
             print("Candidate job configs:")
@@ -786,15 +1128,44 @@ if __name__ == "__main__":
             sys.exit(0)
         print()
 
+    # sbatch files and the summary yaml are all written in local_out_dir
+    if not dry_run:
+        local_out_dir.mkdir(parents=True, exist_ok=True)
+
+    # (job_conf, templated, sbatch_path) for each job
+    submissions = []
+
+    # Values shared by most jobs: only computed again for jobs overriding them
+    base_outdir = str(outdir)
+    base_venv = str(resolve(conf["venv"]))
+    # {(code_dir, git_checkout, clone_as_https): formatted code_dir}
+    code_dirs = {}
+    # per-job paths are built as strings: cheaper than Path objects
+    sbatch_dir = str(local_out_dir)
+    # {templated: index of the first job rendering it}, to skip duplicate jobs
+    rendered = {}
+
     for i, job_dict in enumerate(job_dicts):
-        job_conf = conf.copy()
-        job_conf = deep_update(job_conf, job_dict.pop("slurm", {}))
-        job_conf = deep_update(job_conf, job_dict)
-        job_conf = deep_update(job_conf, args)  # cli has the final say
-
-        job_conf["code_dir"] = code_dir_for_slurm_tmp_dir_checkout(job_conf)
-        job_conf["outdir"] = str(resolve(job_conf["outdir"]))
-        job_conf["venv"] = str(resolve(job_conf["venv"]))
+        job_slurm = job_dict.pop("slurm", {})
+        # cli has the final say
+        job_conf = merge_priority([args, job_dict, job_slurm, conf])
+
+        code_dir_key = (
+            job_conf["code_dir"],
+            job_conf["git_checkout"],
+            job_conf["clone_as_https"],
+        )
+        if code_dir_key not in code_dirs:
+            code_dirs[code_dir_key] = code_dir_for_slurm_tmp_dir_checkout(job_conf)
+        job_conf["code_dir"] = code_dirs[code_dir_key]
+        if job_conf["outdir"] == conf["outdir"]:
+            job_conf["outdir"] = base_outdir
+        else:
+            job_conf["outdir"] = str(resolve(job_conf["outdir"]))
+        if job_conf["venv"] == conf["venv"]:
+            job_conf["venv"] = base_venv
+        else:
+            job_conf["venv"] = str(resolve(job_conf["venv"]))
         job_conf["script_args"] = script_dict_to_script_args_str(
             job_conf.get("script", {})
         )
@@ -802,93 +1173,122 @@ if __name__ == "__main__":
             job_conf["script_args"] += " "
         job_conf["script_args"] += cli_script_args
 
-        # filter out useless args for the template
-        template_values = {
-            k: str(v) for k, v in job_conf.items() if k in template_known_keys
-        }
-        # Make sure all the keys in the template are in the args
-        if set(template_known_keys) != set(template_values.keys()):
-            print(f"template keys: {template_known_keys}")
-            print(f"template values: {template_values}")
-            raise ValueError(
-                "template keys != template args (see details printed above)"
-            )
-
-        # format template for this run
-        templated = template.format(**template_values)
+        # format template for this run. Fails if a template key is missing
+        templated = render_template(template_parts, job_conf)
         templated = clean_sbatch_params(templated)  # remove empty #SBATCH params
 
+        if conf.get("dedupe_jobs"):
+            if templated in rendered:
+                print(
+                    f"  ♻️  Skipping job {i}: same sbatch as job {rendered[templated]}"
+                )
+                continue
+            rendered[templated] = i
+
         # set output path for the sbatch file to execute in order to submit the job
         if jobs_conf_path is not None:
-            sbatch_path = local_out_dir / f"{jobs_conf_path.stem}_{now}_{i}.sbatch"
+            sbatch_name = f"{jobs_conf_path.stem}_{now}_{i}.sbatch"
         else:
-            sbatch_path = local_out_dir / f"{job_conf['job_name']}_{now}.sbatch"
+            sbatch_name = f"{job_conf['job_name']}_{now}.sbatch"
+        sbatch_path = os.path.join(sbatch_dir, sbatch_name)
 
-        if not dry_run:
-            # make sure the sbatch file parent directory exists
-            sbatch_path.parent.mkdir(parents=True, exist_ok=True)
-            # write template
-            sbatch_path.write_text(templated)
+        submissions.append((job_conf, templated, sbatch_path))
+
+    # Group jobs into SLURM job arrays if requested
+    sbatches = batch_submissions(submissions, conf.get("array_batch") or 0)
+
+    # Submit jobs to SLURM concurrently: sbatch mostly waits for the SLURM
+    # controller. Outputs (or errors) are kept in submission order.
+    sbatch_outputs = [None] * len(sbatches)
+    if not dry_run:
+        with ThreadPoolExecutor(max_workers=SBATCH_WORKERS) as executor:
+            futures = [executor.submit(submit_sbatch, s[1]) for s in sbatches]
+        # a failed submission must not prevent recording the successful ones
+        sbatch_outputs = [f.exception() or f.result() for f in futures]
+
+    for (job_confs, templated, sbatch_path), sbatch_output in zip(
+        sbatches, sbatch_outputs
+    ):
+        if isinstance(sbatch_output, Exception):
             print()
-            # Submit job to SLURM
-            out = popen(f"sbatch {sbatch_path}").read().strip()
-            # Identify printed-out job id
-            job_id = re.findall(r"Submitted batch job (\d+)", out)[0]
-            job_ids.append(job_id)
-            print("  ✅ " + out)
-            # Rename sbatch file with job id
-            parts = sbatch_path.stem.split(f"_{now}")
-            new_name = f"{parts[0]}_{job_id}_{now}.sbatch"
-            sbatch_path = sbatch_path.rename(sbatch_path.parent / new_name)
+            print(indent(f"❌ {sbatch_output}", " " * 2))
+            # keep the script, without job id, to inspect or re-submit it
+            Path(sbatch_path).write_bytes(templated.encode("utf-8"))
             print(f"  🏷  Created {relative_to_cwd(sbatch_path, as_str=True)}")
-            # Write job ID & output file path in the sbatch file
-            job_output_file = str(outdir / f"{job_conf['job_name']}-{job_id}.out")
-            job_out_files.append(job_output_file)
-            print(
-                "  📝 Job output file will be: "
-                + relative_to_cwd(job_output_file, as_str=True)
-            )
+            failures.append(sbatch_path)
+        elif sbatch_output is not None:
+            print()
+            out, job_id = sbatch_output
+            print("  ✅ " + out)
+            # one job id per array task
+            sbatch_job_ids = [job_id]
+            if len(job_confs) > 1:
+                sbatch_job_ids = [f"{job_id}_{t}" for t in range(len(job_confs))]
+            sbatch_out_files = [
+                os.path.join(base_outdir, f"{job_conf['job_name']}-{j}.out")
+                for job_conf, j in zip(job_confs, sbatch_job_ids)
+            ]
+            job_ids += sbatch_job_ids
+            job_out_files += sbatch_out_files
+            # Write the sbatch file once, named after the job id and with the job
+            # ID & output file path(s)
+            prefix = os.path.basename(sbatch_path).split(f"_{now}")[0]
+            sbatch_path = os.path.join(sbatch_dir, f"{prefix}_{job_id}_{now}.sbatch")
             templated += (
                 "\n# SLURM_JOB_ID: "
                 + job_id
-                + "\n# Output file: "
-                + job_output_file
+                + "".join(f"\n# Output file: {f}" for f in sbatch_out_files)
                 + "\n"
             )
-            sbatch_path.write_text(templated)
+            Path(sbatch_path).write_bytes(templated.encode("utf-8"))
+            print(f"  🏷  Created {relative_to_cwd(sbatch_path, as_str=True)}")
+            for job_output_file in sbatch_out_files:
+                print(
+                    "  📝 Job output file will be: "
+                    + relative_to_cwd(job_output_file, as_str=True)
+                )
 
         # final prints for dry_run & verbose mode
         if dry_run or conf.get("verbose"):
+            to_print = ""
             if dry_run:
-                print("\nDRY RUN: would have writen in sbatch file:", str(sbatch_path))
-            sbatch_to_print = "#" * 40 + " <sbatch> " + "#" * 40 + "\n"
-            sbatch_to_print += templated
-            sbatch_to_print += "\n" + "#" * 40 + " </sbatch> " + "#" * 39
-            print(indent(sbatch_to_print, " " * 5))
-            print()
+                to_print = (
+                    f"\nDRY RUN: would have writen in sbatch file: {sbatch_path}\n"
+                )
+            sbatch_to_print = f"{SBATCH_HEADER}\n{templated}\n{SBATCH_FOOTER}"
+            # single print per job
+            print(to_print + indent(sbatch_to_print, " " * 5) + "\n")
 
     # Recap submitted jobs. Useful for scancel for instance.
     jobs_str = "⚠️ No job submitted!"
     if job_ids:
         jobs_str = "All jobs submitted: " + " ".join(job_ids)
-        print(f"\n🚀 Submitted job {i+1}/{len(job_dicts)}")
+        print(f"\n🚀 Submitted job {len(job_ids)}/{len(job_dicts)}")
 
     # make copy of original yaml conf and append all the sbatch info:
     if jobs_conf_path is not None:
-        conf = jobs_conf_path.read_text()
         new_conf_path = local_out_dir / f"{jobs_conf_path.stem}_{now}.yaml"
-        new_conf_path.parent.mkdir(parents=True, exist_ok=True)
-        conf += f"\n# Command run: {' '.join(sys.argv)}\n"
-        conf += "\n# " + jobs_str + "\n"
-        conf += (
-            "\n# Job Output files:\n#"
-            + "\n#".join([f"  • {f}" for f in job_out_files])
-            + "\n"
+        conf = "".join(
+            (
+                jobs_conf_path.read_bytes().decode("utf-8"),
+                f"\n# Command run: {' '.join(sys.argv)}\n",
+                f"\n# {jobs_str}\n",
+                "\n# Job Output files:\n#",
+                "\n#".join(f"  • {f}" for f in job_out_files),
+                "\n",
+            )
         )
         rel = relative_to_cwd(new_conf_path)
         if not dry_run:
-            new_conf_path.write_text(conf)
+            new_conf_path.write_bytes(conf.encode("utf-8"))
             print(f"   Created summary YAML in {rel}")
 
     if job_ids:
         print(f"   {jobs_str}\n")
+
+    if failures:
+        print(f"   ❌ {len(failures)}/{len(sbatches)} sbatch submissions failed:")
+        for sbatch_path in failures:
+            print(f"     • {relative_to_cwd(sbatch_path, as_str=True)}")
+        print()
+        sys.exit(1)
@@ -1,14 +1,10 @@
-import argparse
 import os
+import sys
 
 if __name__ == "__main__":
-    # parse all incoming arbitrary arguments:
-    parser = argparse.ArgumentParser()
-    a, b = parser.parse_known_args()
+    # all incoming arbitrary arguments are unknown: no need for argparse
+    a, b = [], sys.argv[1:]
 
-    print("Job", os.environ["SLURM_JOB_ID"], "started.")
-
-    print(a)
-    print(b)
-
-    print("Done.")
+    # single write to the job's output file
+    job_id = os.environ["SLURM_JOB_ID"]
+    sys.stdout.write(f"Job {job_id} started.\n{a!r}\n{b!r}\nDone.\n")